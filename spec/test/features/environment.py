@@ -13,9 +13,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import suppress
+import signal
 import tempfile
+import sys
 import os
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "steps"))
+
+
+def before_all(context):
+    import kapowserver
+    kapowserver.start_kapow_server(context)
+
 
 def before_scenario(context, scenario):
     # Create the request_handler FIFO
@@ -32,8 +43,34 @@ def before_scenario(context, scenario):
 
 
 def after_scenario(context, scenario):
-    if hasattr(context, 'server'):
-        context.server.terminate()
-        context.server.wait()
+    import kapowserver
+
+    # Scenarios are not required to release their testing request.  Now
+    # that the server outlives the scenario, an unreleased request would
+    # pin a BACKGROUND worker on the in-flight GET forever and leak a
+    # paused testinghandler process, so finish it here.
+    request = getattr(context, 'testing_request', None)
+    if request is not None and not request.done():
+        if hasattr(context, 'testing_handler_pid'):
+            with suppress(ProcessLookupError):
+                os.kill(int(context.testing_handler_pid), signal.SIGTERM)
+            with suppress(FutureTimeoutError):
+                request.result(timeout=kapowserver.BOOT_TIMEOUT)
+        else:
+            # The handler never connected; at worst the future is still
+            # queued and can be cancelled.
+            request.cancel()
 
     os.unlink(context.handler_fifo_path)
+
+
+def after_all(context):
+    import kapowserver
+
+    server = context.config.userdata.get("kapow_server")
+    if server is not None:
+        server.terminate()
+        server.wait()
+
+    kapowserver.BACKGROUND.shutdown()
+    kapowserver.SESSION.close()
@@ -18,41 +18,62 @@ from itertools import zip_longest
 from jsonexample import ANY
 
 
-def assert_same_type(f):
-    def wrapper(a, b):
-        if type(a) != type(b):
-            raise TypeError(f"Non-matching types {a!r} != {b!r}")
-        return f(a, b)
+def assert_same_type(model, matcher):
+    def wrapper(obj):
+        if type(model) != type(obj):
+            raise TypeError(f"Non-matching types {model!r} != {obj!r}")
+        return matcher(obj)
     return wrapper
 
 
 @singledispatch
-@assert_same_type
-def is_subset(model, obj):
-    if model == obj:
+def compile_model(model):
+    """Build a matcher closure accepting any object subsuming `model`.
+
+    The model tree is walked once at compile time so a matcher reused
+    against several objects doesn't re-dispatch per node.
+    """
+    def match(obj):
+        if model == obj:
+            return True
+        else:
+            raise ValueError(f"Non-matching values {model!r} != {obj!r}")
+    return assert_same_type(model, match)
+
+
+@compile_model.register(dict)
+def _(model):
+    matchers = {key: compile_model(value) for key, value in model.items()}
+
+    def match(obj):
+        for key, matcher in matchers.items():
+            if key not in obj or not matcher(obj[key]):
+                raise ValueError(f"Non-matching dicts {model!r} != {obj!r}")
         return True
-    else:
-        raise ValueError(f"Non-matching values {model!r} != {obj!r}")
+    return assert_same_type(model, match)
 
 
-@is_subset.register(dict)
-@assert_same_type
-def _(model, obj):
-    for key, value in model.items():
-        if key not in obj or not is_subset(value, obj[key]):
-            raise ValueError(f"Non-matching dicts {model!r} != {obj!r}")
-    return True
+@compile_model.register(list)
+def _(model):
+    matchers = [compile_model(value) for value in model]
+
+    def match(obj):
+        for matcher, b in zip_longest(matchers, obj):
+            if matcher is None:
+                # `obj` is longer than the model
+                matcher = compile_model(None)
+            if not matcher(b):
+                raise ValueError(f"Non-matching list member in {b!r}")
+        return True
+    return assert_same_type(model, match)
 
 
-@is_subset.register(list)
-@assert_same_type
-def _(model, obj):
-    for a, b in zip_longest(model, obj):
-        if not is_subset(a, b):
-            raise ValueError(f"Non-matching list member {a!r} in {b!r}")
-    return True
+@compile_model.register(ANY)
+def _(model):
+    def match(obj):
+        return True
+    return match
 
 
-@is_subset.register(ANY)
-def _(model, obj):
-    return True
+def is_subset(model, obj):
+    return compile_model(model)(obj)
@@ -0,0 +1,204 @@
+#
+# Copyright 2019 Banco Bilbao Vizcaya Argentaria, S.A.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Shared plumbing to drive the Kapow! server under test.
+
+This module is imported both by the step definitions and by
+``environment.py``; unlike ``steps.py`` it does not rely on the names
+behave injects into step modules, so it is importable anywhere.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from time import sleep
+import logging
+import os
+import shlex
+import subprocess
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from environconfig import EnvironConfig, StringVar, IntVar, BooleanVar
+
+
+class Env(EnvironConfig):
+    #: How to run Kapow! server
+    KAPOW_SERVER_CMD = StringVar(default="kapow server")
+
+    #: Where the Control API is
+    KAPOW_CONTROLAPI_URL = StringVar(default="http://localhost:8081")
+
+    #: Where the Data API is
+    KAPOW_DATAAPI_URL = StringVar(default="http://localhost:8082")
+
+    #: Where the User Interface is
+    KAPOW_USER_URL = StringVar(default="http://localhost:8080")
+
+    KAPOW_BOOT_TIMEOUT = IntVar(default=1000)
+
+    KAPOW_DEBUG_TESTS = BooleanVar(default=False)
+
+
+#: EnvironConfig descriptors re-read the environment on every access,
+#: so bind the values (and the URLs built from them) once at import.
+CONTROL_URL = Env.KAPOW_CONTROLAPI_URL
+DATA_URL = Env.KAPOW_DATAAPI_URL
+USER_URL = Env.KAPOW_USER_URL
+#: KAPOW_BOOT_TIMEOUT historically counted 10ms poll iterations, not
+#: seconds; keep that meaning and convert to seconds (default 1000 ->
+#: 10s) for the deadline-based waits.
+BOOT_TIMEOUT = Env.KAPOW_BOOT_TIMEOUT / 100
+ROUTES_URL = f"{CONTROL_URL}/routes"
+HANDLERS_URL = f"{DATA_URL}/handlers"
+SERVER_ARGV = shlex.split(Env.KAPOW_SERVER_CMD)
+
+
+def json_body(response):
+    """Parse a response body, with orjson when it is available."""
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+#: Shared session so every step reuses the same keep-alive connections
+#: instead of paying a TCP handshake per request.
+SESSION = requests.Session()
+#: Everything talks to localhost, so skip the per-request environment
+#: scan for proxies and certificate bundles.
+SESSION.trust_env = False
+SESSION.mount("http://",
+              HTTPAdapter(pool_connections=4,
+                          pool_maxsize=32,
+                          max_retries=0))
+
+#: Reusable workers for the in-flight testing requests; spinning up a
+#: fresh thread pool per request pays thread startup on the hot path
+#: and leaks a thread per scenario.
+BACKGROUND = ThreadPoolExecutor(max_workers=4, thread_name_prefix="kapow-bg")
+
+
+def enable_debug_logging():
+    # Enable debugging at httplib level
+    # (requests->urllib3->http.client).  You will see the REQUEST,
+    # including HEADERS and DATA, and RESPONSE with HEADERS but without
+    # DATA.  The only thing missing will be the response.body which is
+    # not logged.
+    import http.client as http_client
+    import logging.handlers
+    http_client.HTTPConnection.debuglevel = 1
+
+    # You must initialize logging, otherwise you'll not see debug output.
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.DEBUG)
+
+    def buffered_stream_handler():
+        # Buffer debug records so every request doesn't serialize on a
+        # stdout write lock; the buffer is flushed when full and on
+        # logging shutdown.
+        return logging.handlers.MemoryHandler(
+            capacity=256, target=logging.StreamHandler())
+
+    # httplib reports through bare print(); reroute it to a buffered
+    # logger with lazy formatting.
+    http_log = logging.getLogger("http.client")
+    http_log.setLevel(logging.DEBUG)
+    http_log.propagate = False
+    http_log.addHandler(buffered_stream_handler())
+    http_client.print = lambda *args: http_log.debug(
+        "%s", " ".join(map(str, args)))
+
+    requests_log = logging.getLogger("requests.packages.urllib3")
+    requests_log.setLevel(logging.DEBUG)
+    requests_log.propagate = False
+    requests_log.addHandler(buffered_stream_handler())
+
+
+if Env.KAPOW_DEBUG_TESTS:
+    enable_debug_logging()
+
+
+#: Opened once at import; passing a plain fd (instead of
+#: subprocess.DEVNULL) saves an open/close per spawn, and together with
+#: close_fds=False lets Popen use CPython's posix_spawn fast path.
+DEVNULL_FD = os.open(os.devnull, os.O_RDWR)
+
+
+def start_kapow_server(context):
+    """Spawn a fresh `kapow server` process and wait for its APIs."""
+    context.server = subprocess.Popen(
+        SERVER_ARGV,
+        stdout=DEVNULL_FD,
+        stderr=DEVNULL_FD,
+        close_fds=False,
+        shell=False)
+    context.config.userdata["kapow_server"] = context.server
+
+    # Check process is running with reachable APIs.  Poll with a short
+    # exponential backoff so fast boots are detected in milliseconds
+    # while slow boots still get the whole KAPOW_BOOT_TIMEOUT budget.
+    open_ports = False
+    deadline = time.monotonic() + BOOT_TIMEOUT
+    delay = 0.01
+    while time.monotonic() < deadline:
+        is_running = context.server.poll() is None
+        assert is_running, "Server is not running!"
+        with suppress(requests.exceptions.ConnectionError):
+            open_ports = (
+                SESSION.head(CONTROL_URL, timeout=.25).status_code
+                and SESSION.head(DATA_URL, timeout=.25).status_code)
+            if open_ports:
+                break
+        sleep(min(delay, max(deadline - time.monotonic(), 0)))
+        delay = min(delay * 1.6, 0.25)
+
+    assert open_ports, "API is unreachable after KAPOW_BOOT_TIMEOUT"
+
+
+def parallel_requests(reqs, max_workers=8):
+    """Fire independent requests concurrently, preserving order.
+
+    `reqs` is an iterable of (method, url, kwargs) tuples.  Only use
+    this when the requests do not depend on each other nor on server
+    state ordering (e.g. route deletion, never route creation).
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(
+            lambda req: SESSION.request(req[0], req[1], **req[2]),
+            reqs))
+
+
+def reset_kapow_server():
+    """Wipe all routes so the shared server looks freshly booted."""
+    routes = json_body(SESSION.get(ROUTES_URL))
+    for response in parallel_requests(
+            ("DELETE", f"{ROUTES_URL}/{route['id']}", {})
+            for route in routes):
+        response.raise_for_status()
+
+
+def run_kapow_server(context):
+    # Reuse the suite-wide server started from before_all; forking and
+    # boot-probing a new process per scenario is the dominant cost of
+    # the suite.  Only respawn if the shared server died.
+    server = context.config.userdata.get("kapow_server")
+    if server is not None and server.poll() is None:
+        context.server = server
+        reset_kapow_server()
+    else:
+        start_kapow_server(context)
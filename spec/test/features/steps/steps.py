@@ -13,91 +13,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-from contextlib import suppress
+from functools import lru_cache
 from time import sleep
-import json
 import os
+import selectors
 import shlex
 import signal
-import socket
-import subprocess
 import sys
-import tempfile
-import threading
-from multiprocessing.pool import ThreadPool
 import time
 
-import requests
-from environconfig import EnvironConfig, StringVar, IntVar, BooleanVar
-from comparedict import is_subset
+from comparedict import compile_model
+from kapowserver import (BACKGROUND, BOOT_TIMEOUT, HANDLERS_URL, ROUTES_URL,
+                         SESSION, USER_URL, json_body, run_kapow_server)
 import jsonexample
 
-import logging
-
 
 WORD2POS = {"first": 0, "second": 1, "last": -1}
 HERE = os.path.dirname(__file__)
 
+#: Scenario-invariant prefix of the testing handler entrypoint; only
+#: the FIFO path has to be quoted per scenario.
+TESTING_HANDLER_PREFIX = " ".join(
+    [sys.executable, shlex.quote(os.path.join(HERE, "testinghandler.py"))])
 
-class Env(EnvironConfig):
-    #: How to run Kapow! server
-    KAPOW_SERVER_CMD = StringVar(default="kapow server")
-
-    #: Where the Control API is
-    KAPOW_CONTROLAPI_URL = StringVar(default="http://localhost:8081")
-
-    #: Where the Data API is
-    KAPOW_DATAAPI_URL = StringVar(default="http://localhost:8082")
-
-    #: Where the User Interface is
-    KAPOW_USER_URL = StringVar(default="http://localhost:8080")
-
-    KAPOW_BOOT_TIMEOUT = IntVar(default=1000)
-
-    KAPOW_DEBUG_TESTS = BooleanVar(default=False)
-
-
-if Env.KAPOW_DEBUG_TESTS:
-    # These two lines enable debugging at httplib level
-    # (requests->urllib3->http.client) You will see the REQUEST,
-    # including HEADERS and DATA, and RESPONSE with HEADERS but without
-    # DATA.  The only thing missing will be the response.body which is
-    # not logged.
-    try:
-        import http.client as http_client
-    except ImportError:
-        # Python 2
-        import httplib as http_client
-    http_client.HTTPConnection.debuglevel = 1
-
-    # You must initialize logging, otherwise you'll not see debug output.
-    logging.basicConfig()
-    logging.getLogger().setLevel(logging.DEBUG)
-    requests_log = logging.getLogger("requests.packages.urllib3")
-    requests_log.setLevel(logging.DEBUG)
-    requests_log.propagate = True
-
-def run_kapow_server(context):
-    context.server = subprocess.Popen(
-        shlex.split(Env.KAPOW_SERVER_CMD),
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-        shell=False)
-
-    # Check process is running with reachable APIs
-    open_ports = False
-    for _ in range(Env.KAPOW_BOOT_TIMEOUT):
-        is_running = context.server.poll() is None
-        assert is_running, "Server is not running!"
-        with suppress(requests.exceptions.ConnectionError):
-            open_ports = (
-                requests.head(Env.KAPOW_CONTROLAPI_URL, timeout=1).status_code
-                and requests.head(Env.KAPOW_DATAAPI_URL, timeout=1).status_code)
-            if open_ports:
-                break
-        sleep(.01)
-
-    assert open_ports, "API is unreachable after KAPOW_BOOT_TIMEOUT"
 
 @given('I have a just started Kapow! server')
 @given('I have a running Kapow! server')
@@ -107,55 +45,86 @@ def step_impl(context):
 
 @when('I request a routes listing')
 def step_impl(context):
-    context.response = requests.get(f"{Env.KAPOW_CONTROLAPI_URL}/routes")
+    context.response = SESSION.get(ROUTES_URL)
 
 
-@given('I have a Kapow! server with the following routes')
-def step_impl(context):
-    run_kapow_server(context)
+def create_routes(context, **defaults):
+    """Append every route of `context.table` to the running server.
 
+    Routes are appended in table order with a single keep-alive
+    connection; order matters because the server matches routes in
+    insertion order and some scenarios assert it.
+    """
     if not hasattr(context, 'table'):
         raise RuntimeError("A table must be set for this step.")
 
-    for row in context.table:
-        response = requests.post(f"{Env.KAPOW_CONTROLAPI_URL}/routes",
-                                 json={h: row[h] for h in row.headings})
+    payload = [{**defaults, **{h: row[h] for h in row.headings}}
+               for row in context.table]
+    for route in payload:
+        response = SESSION.post(ROUTES_URL,
+                                json=route)
         response.raise_for_status()
 
 
-@given('I have a Kapow! server with the following testing routes')
+@given('I have a Kapow! server with the following routes')
 def step_impl(context):
     run_kapow_server(context)
+    create_routes(context)
 
-    if not hasattr(context, 'table'):
-        raise RuntimeError("A table must be set for this step.")
 
-    for row in context.table:
-        response = requests.post(
-            f"{Env.KAPOW_CONTROLAPI_URL}/routes",
-            json={"entrypoint": " ".join(
-                      [sys.executable,
-                       shlex.quote(os.path.join(HERE, "testinghandler.py")),
-                       shlex.quote(context.handler_fifo_path)]),  # Created in before_scenario
-                  **{h: row[h] for h in row.headings}})
-        response.raise_for_status()
+@given('I have a Kapow! server with the following testing routes')
+def step_impl(context):
+    run_kapow_server(context)
+    create_routes(
+        context,
+        entrypoint=(f"{TESTING_HANDLER_PREFIX} "
+                    # Created in before_scenario
+                    f"{shlex.quote(context.handler_fifo_path)}"))
+
+def read_handler_handshake(fifo_path, timeout):
+    """Read the `pid;handler_id` line the testing handler writes.
+
+    The FIFO is opened nonblocking and watched with a selector so a
+    crashed handler cannot block the suite forever; a plain blocking
+    open()+readline() would hang until a writer shows up.
+    """
+    # O_RDWR keeps a writer end open on our side, so the fd never polls
+    # as end-of-file while the handler is still starting and select()
+    # only wakes up on actual data.
+    fd = os.open(fifo_path, os.O_RDWR | os.O_NONBLOCK)
+    try:
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            deadline = time.monotonic() + timeout
+            data = b''
+            while b'\n' not in data:
+                remaining = deadline - time.monotonic()
+                assert remaining > 0, \
+                    "Testing handler did not connect before the timeout"
+                if selector.select(timeout=remaining):
+                    data += os.read(fd, 4096)
+    finally:
+        os.close(fd)
+
+    return data.decode().rstrip('\n').split(';')
+
 
 def testing_request(context, request_fn):
     # Run the request in background
-    context.testing_request = ThreadPool(processes=1).apply_async(request_fn)
+    context.testing_request = BACKGROUND.submit(request_fn)
 
-    # Block until the handler connects and give us its pid and the
+    # Wait until the handler connects and gives us its pid and the
     # handler_id
-    with open(context.handler_fifo_path, 'r') as fifo:
-        (context.testing_handler_pid,
-         context.testing_handler_id) = fifo.readline().rstrip('\n').split(';')
+    (context.testing_handler_pid,
+     context.testing_handler_id) = read_handler_handshake(
+         context.handler_fifo_path, BOOT_TIMEOUT)
 
 
 @when('I send a request to the testing route "{path}"')
 def step_impl(context, path):
     def _request():
         try:
-            return requests.get(f"{Env.KAPOW_USER_URL}{path}", stream=False)
+            return SESSION.get(f"{USER_URL}{path}", stream=False)
         except:
             return None
 
@@ -165,12 +134,13 @@ def step_impl(context, path):
 @when('I release the testing request')
 def step_impl(context):
     os.kill(int(context.testing_handler_pid), signal.SIGTERM)
-    context.testing_response = context.testing_request.get()
+    context.testing_response = context.testing_request.result(
+        timeout=BOOT_TIMEOUT)
 
 
 @when('I append the route')
 def step_impl(context):
-    context.response = requests.post(f"{Env.KAPOW_CONTROLAPI_URL}/routes",
+    context.response = SESSION.post(ROUTES_URL,
                                      data=context.text,
                                      headers={"Content-Type": "application/json"})
 
@@ -200,9 +170,16 @@ def step_impl(context, reason):
     assert context.response.reason == reason, f"Got {context.response.reason} instead"
 
 
+@lru_cache(maxsize=256)
+def compiled_matcher(text):
+    # Expected-body templates are fixed in the feature files, so the
+    # parse and the matcher compilation are shared across scenarios.
+    return compile_model(jsonexample.loads(text))
+
+
 @then('I get the following response body')
 def step_impl(context):
-    assert is_subset(jsonexample.loads(context.text), context.response.json())
+    assert compiled_matcher(context.text)(json_body(context.response))
 
 
 @then('I get the following response raw body')
@@ -212,50 +189,55 @@ def step_impl(context):
 
 @when('I delete the route with id "{id}"')
 def step_impl(context, id):
-    context.response = requests.delete(f"{Env.KAPOW_CONTROLAPI_URL}/routes/{id}")
+    context.response = SESSION.delete(f"{ROUTES_URL}/{id}")
 
 
 @when('I insert the route')
 def step_impl(context):
-    context.response = requests.put(f"{Env.KAPOW_CONTROLAPI_URL}/routes",
+    context.response = SESSION.put(ROUTES_URL,
                                     headers={"Content-Type": "application/json"},
                                     data=context.text)
 
 
 @when('I try to append with this malformed JSON document')
 def step_impl(context):
-    context.response = requests.post(
-        f"{Env.KAPOW_CONTROLAPI_URL}/routes",
+    context.response = SESSION.post(
+        ROUTES_URL,
         headers={"Content-Type": "application/json"},
         data=context.text)
 
 
+def route_id_at(idx):
+    """Return the id of the route at `idx` in the current listing.
+
+    The Control API cannot filter or limit the listing, so the whole
+    (small) payload is fetched and indexed locally.
+    """
+    return json_body(SESSION.get(ROUTES_URL))[idx]["id"]
+
+
 @when('I delete the {order} route')
 def step_impl(context, order):
-    idx = WORD2POS.get(order)
-    routes = requests.get(f"{Env.KAPOW_CONTROLAPI_URL}/routes")
-    id = routes.json()[idx]["id"]
-    context.response = requests.delete(f"{Env.KAPOW_CONTROLAPI_URL}/routes/{id}")
+    id = route_id_at(WORD2POS.get(order))
+    context.response = SESSION.delete(f"{ROUTES_URL}/{id}")
 
 
 @when('I try to insert with this JSON document')
 def step_impl(context):
-    context.response = requests.put(
-        f"{Env.KAPOW_CONTROLAPI_URL}/routes",
+    context.response = SESSION.put(
+        ROUTES_URL,
         headers={"Content-Type": "application/json"},
         data=context.text)
 
 @when('I get the route with id "{id}"')
 def step_impl(context, id):
-    context.response = requests.get(f"{Env.KAPOW_CONTROLAPI_URL}/routes/{id}")
+    context.response = SESSION.get(f"{ROUTES_URL}/{id}")
 
 
 @when('I get the {order} route')
 def step_impl(context, order):
-    idx = WORD2POS.get(order)
-    routes = requests.get(f"{Env.KAPOW_CONTROLAPI_URL}/routes")
-    id = routes.json()[idx]["id"]
-    context.response = requests.get(f"{Env.KAPOW_CONTROLAPI_URL}/routes/{id}")
+    id = route_id_at(WORD2POS.get(order))
+    context.response = SESSION.get(f"{ROUTES_URL}/{id}")
 
 
 @when('I get the resource "{resource}"')
@@ -264,14 +246,14 @@ def step_impl(context, resource, handler_id=None):
     if handler_id is None:
         handler_id = context.testing_handler_id
 
-    context.response = requests.get(
-        f"{Env.KAPOW_DATAAPI_URL}/handlers/{handler_id}{resource}")
+    context.response = SESSION.get(
+        f"{HANDLERS_URL}/{handler_id}{resource}")
 
 
 @when('I set the resource "{resource}" with value "{value}"')
 def step_impl(context, resource, value):
-    context.response = requests.put(
-        f"{Env.KAPOW_DATAAPI_URL}/handlers/{context.testing_handler_id}{resource}",
+    context.response = SESSION.put(
+        f"{HANDLERS_URL}/{context.testing_handler_id}{resource}",
         data=value.encode("utf-8"))
 
 
@@ -295,7 +277,7 @@ def step_impl(context, path):
 
     def _request():
         try:
-            return requests.get(f"{Env.KAPOW_USER_URL}{path}",
+            return SESSION.get(f"{USER_URL}{path}",
                                 stream=False,
                                 **params)
         except: